@@ -14,8 +14,28 @@
 __all__ = (
     "BTreeMap",
     "BTreeSet",
+    "DurableBTreeMap",
+    "LRUCache",
+    "RBStats",
+    "TTLCache",
+    "merge_iter",
 )
 
+import collections.abc
+import heapq
+import itertools
+import operator
+import os
+import pickle
+import struct
+import time
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # -----------------------------------------------------------------------------
 # Functional B-Tree Implementation
 
@@ -25,6 +45,11 @@ BLACK = True
 RED = False
 
 
+def rb_alloc(cls):
+    # malloc(sizeof(node));
+    return cls()
+
+
 def rb_free(node):
     del node.key
     del node.color
@@ -83,7 +108,7 @@ def rb_fixup_insert(node):
 
 def rb_insert_recursive(node, key, cls):
     if node is None:
-        node = cls()
+        node = rb_alloc(cls)
         return node, node
 
     res = key_cmp(key, node.key)
@@ -116,6 +141,21 @@ def rb_lookup(node, key):
     return None
 
 
+def rb_floor(node, key):
+    # get the node with the largest key <= key
+    node_floor = None
+    while node is not None:
+        cmp = key_cmp(key, node.key)
+        if cmp == 0:
+            return node
+        if cmp < 0:
+            node = node.left
+        else:
+            node_floor = node
+            node = node.right
+    return node_floor
+
+
 def rb_min(node):
     # -> Node
     if node is None:
@@ -125,6 +165,15 @@ def rb_min(node):
     return node
 
 
+def rb_max(node):
+    # -> Node
+    if node is None:
+        return None
+    while node.right is not None:
+        node = node.right
+    return node
+
+
 def rb_fixup_remove(node):
     # -> Node
     if is_red(node.right):
@@ -252,6 +301,48 @@ def rb_copy_recursive(node):
     return copy
 
 
+def rb_build_sorted_recursive(nodes, lo, hi, black):
+    # Build a subtree from ``nodes[lo:hi]`` with the given black height,
+    # as a 2-3 tree: a subtree of black height ``h``
+    # holds between ``2 ** h - 1`` and ``3 ** h - 1`` nodes.
+    if black == 0:
+        # assert(lo == hi)
+        return None
+    black -= 1
+    size = hi - lo
+    if size <= 2 * (3 ** black - 1) + 1:
+        # 2-node.
+        mid = lo + (size - 1) // 2
+        node = nodes[mid]
+        node.left = rb_build_sorted_recursive(nodes, lo, mid, black)
+        node.right = rb_build_sorted_recursive(nodes, mid + 1, hi, black)
+    else:
+        # 3-node, the smaller key is the red left child.
+        size_a = (size - 2) // 3
+        size_b = (size - 2 - size_a) // 2
+        mid_red = lo + size_a
+        mid = mid_red + 1 + size_b
+        node_red = nodes[mid_red]
+        node_red.left = rb_build_sorted_recursive(nodes, lo, mid_red, black)
+        node_red.right = rb_build_sorted_recursive(nodes, mid_red + 1, mid, black)
+        node_red.color = RED
+        node = nodes[mid]
+        node.left = node_red
+        node.right = rb_build_sorted_recursive(nodes, mid + 1, hi, black)
+    node.color = BLACK
+    return node
+
+
+def rb_build_sorted(nodes):
+    """ Link a list of nodes (sorted by key, without duplicates)
+        into a tree in ``O(n)``, returning the root.
+    """
+    black = 0
+    while 3 ** black - 1 < len(nodes):
+        black += 1
+    return rb_build_sorted_recursive(nodes, 0, len(nodes), black)
+
+
 def rb_free_recursive(node):
     if node is not None:
         if node.left:
@@ -309,6 +400,189 @@ def rb_is_balanced_and_ordered(root):
     return rb_is_balanced(root) and rb_is_ordered(root)
 
 
+# -----------------------------------------------------------------------------
+# Tree Shape
+#
+# Used for capacity planning, not needed for regular use.
+
+def rb_black_height(root):
+    # number of black nodes on any path from root to a leaf
+    black = 0
+    node = root
+    while node is not None:
+        if not is_red(node):
+            black += 1
+        node = node.left
+    return black
+
+
+def rb_height_recursive(node):
+    if node is None:
+        return 0
+    return 1 + max(
+        rb_height_recursive(node.left),
+        rb_height_recursive(node.right))
+
+
+def rb_count_red_recursive(node):
+    if node is not None:
+        return (
+            (1 if is_red(node) else 0) +
+            rb_count_red_recursive(node.left) +
+            rb_count_red_recursive(node.right))
+    else:
+        return 0
+
+
+def rb_spine_len(node, attr):
+    # number of nodes visited to reach the min ("left") or max ("right")
+    depth = 0
+    while node is not None:
+        depth += 1
+        node = getattr(node, attr)
+    return depth
+
+
+def rb_shape(root):
+    size = rb_count_recursive(root)
+    red = rb_count_red_recursive(root)
+    return {
+        "size": size,
+        "height": rb_height_recursive(root),
+        "black_height": rb_black_height(root),
+        "red": red,
+        "red_ratio": (red / size) if size else 0.0,
+    }
+
+
+# -----------------------------------------------------------------------------
+# Split & Join
+#
+# Black heights are passed along so each join only costs
+# the difference in black height between the trees being joined,
+# keeping a split ``O(log n)`` overall.
+
+def rb_join_right(node, black, mid, right, black_right):
+    # attach ``mid`` & ``right`` along the right spine of ``node``.
+    if black == black_right and not is_red(node):
+        mid.left = node
+        mid.right = right
+        mid.color = RED
+        return mid
+    if not is_red(node):
+        black -= 1
+    node.right = rb_join_right(node.right, black, mid, right, black_right)
+    return rb_fixup_insert(node)
+
+
+def rb_join_left(node, black, mid, left, black_left):
+    # attach ``left`` & ``mid`` along the left spine of ``node``.
+    if black == black_left and not is_red(node):
+        mid.left = left
+        mid.right = node
+        mid.color = RED
+        return mid
+    if not is_red(node):
+        black -= 1
+    node.left = rb_join_left(node.left, black, mid, left, black_left)
+    return rb_fixup_insert(node)
+
+
+def rb_join(left, black_left, mid, right, black_right):
+    """ Join two trees where all keys in ``left`` < ``mid.key`` < all keys in ``right``,
+        returning the root and its black height.
+    """
+    if black_left >= black_right:
+        root = rb_join_right(left, black_left, mid, right, black_right)
+        black = black_left
+    else:
+        root = rb_join_left(right, black_right, mid, left, black_left)
+        black = black_right
+    if is_red(root):
+        root.color = BLACK
+        black += 1
+    return root, black
+
+
+def rb_join_pair(left, black_left, right, black_right):
+    # join without a middle node.
+    if right is None:
+        return left, black_left
+    right, mid = rb_pop_min(right)
+    return rb_join(left, black_left, mid, right, rb_black_height(right))
+
+
+def rb_as_root(node, black):
+    # detach a subtree as a tree of its own (roots are black).
+    if is_red(node):
+        node.color = BLACK
+        black += 1
+    return node, black
+
+
+def rb_split(node, black, key):
+    """ Split a tree by ``key`` into
+        ``(left, black_left, node_found, right, black_right)``
+        where keys in ``left`` are < key and keys in ``right`` are > key,
+        ``node_found`` is the node matching key or None.
+    """
+    if node is None:
+        return None, 0, None, None, 0
+    black_child = black if is_red(node) else black - 1
+    left = node.left
+    right = node.right
+    cmp = key_cmp(key, node.key)
+    if cmp == 0:
+        return (
+            *rb_as_root(left, black_child),
+            node,
+            *rb_as_root(right, black_child),
+        )
+    if cmp < 0:
+        left_split, black_left, node_found, right_split, black_right = rb_split(
+            left, black_child, key)
+        right_split, black_right = rb_join(
+            right_split, black_right, node, *rb_as_root(right, black_child))
+    else:
+        left_split, black_left, node_found, right_split, black_right = rb_split(
+            right, black_child, key)
+        left_split, black_left = rb_join(
+            *rb_as_root(left, black_child), node, left_split, black_left)
+    return left_split, black_left, node_found, right_split, black_right
+
+
+def rb_remove_range(root, lo, hi):
+    """ Detach keys from ``lo`` (inclusive) to ``hi`` (exclusive),
+        None for unbounded, returning ``(root, root_removed)``.
+    """
+    black = rb_black_height(root)
+    # keys < lo, keys >= lo.
+    if lo is None:
+        a, black_a, b, black_b = None, 0, root, black
+    else:
+        a, black_a, node_found, b, black_b = rb_split(root, black, lo)
+        if node_found is not None:
+            b, black_b = rb_join(None, 0, node_found, b, black_b)
+    # keys in range, keys >= hi.
+    if hi is None:
+        c, d, black_d = b, None, 0
+    else:
+        c, _, node_found, d, black_d = rb_split(b, black_b, hi)
+        if node_found is not None:
+            d, black_d = rb_join(None, 0, node_found, d, black_d)
+    root, _ = rb_join_pair(a, black_a, d, black_d)
+    return root, c
+
+
+def rb_remove_after(root, key):
+    """ Detach keys > ``key``, returning ``(root, root_removed)``.
+    """
+    a, black_a, node_found, b, _ = rb_split(root, rb_black_height(root), key)
+    if node_found is not None:
+        a, _ = rb_join(a, black_a, node_found, None, 0)
+    return a, b
+
+
 # -----------------------------------------------------------------------------
 # Pythonic Helpers
 #
@@ -335,6 +609,358 @@ def rb_iter_dir(root, reverse=False):
         yield from rb_iter_forward_recursive(root)
 
 
+def rb_key_in_range(key, lo, hi):
+    # lo is inclusive, hi is exclusive, None for unbounded.
+    return (
+        (lo is None or key_cmp(key, lo) >= 0) and
+        (hi is None or key_cmp(key, hi) < 0))
+
+
+def rb_iter_range_forward_recursive(node, lo, hi):
+    if node is not None:
+        above_lo = lo is None or key_cmp(node.key, lo) >= 0
+        below_hi = hi is None or key_cmp(node.key, hi) < 0
+        if above_lo:
+            yield from rb_iter_range_forward_recursive(node.left, lo, hi)
+            if below_hi:
+                yield node
+        if below_hi:
+            yield from rb_iter_range_forward_recursive(node.right, lo, hi)
+
+
+def rb_iter_range_backward_recursive(node, lo, hi):
+    if node is not None:
+        above_lo = lo is None or key_cmp(node.key, lo) >= 0
+        below_hi = hi is None or key_cmp(node.key, hi) < 0
+        if below_hi:
+            yield from rb_iter_range_backward_recursive(node.right, lo, hi)
+            if above_lo:
+                yield node
+        if above_lo:
+            yield from rb_iter_range_backward_recursive(node.left, lo, hi)
+
+
+def rb_iter_range(root, lo=None, hi=None, reverse=False):
+    """ Iterate over nodes with keys from ``lo`` (inclusive) to ``hi`` (exclusive),
+        skipping subtrees outside the range.
+    """
+    if lo is None and hi is None:
+        yield from rb_iter_dir(root, reverse)
+    elif reverse:
+        yield from rb_iter_range_backward_recursive(root, lo, hi)
+    else:
+        yield from rb_iter_range_forward_recursive(root, lo, hi)
+
+
+def rb_prefix_upper(prefix):
+    # The smallest key greater than all keys starting with ``prefix``
+    # (a ``str`` or ``bytes``), None when there is no upper bound.
+    if isinstance(prefix, str):
+        prefix = prefix.rstrip(chr(0x10ffff))
+        if not prefix:
+            return None
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    elif isinstance(prefix, bytes):
+        prefix = prefix.rstrip(b"\xff")
+        if not prefix:
+            return None
+        return prefix[:-1] + bytes((prefix[-1] + 1,))
+    else:
+        raise TypeError("prefix must be str or bytes, not " + type(prefix).__name__)
+
+
+def rb_iter_prefix(root, prefix, delimiter=None):
+    """ Iterate over keys starting with ``prefix``, yielding ``(node, None)``.
+
+        With a ``delimiter``, keys containing it after the prefix are rolled up,
+        yielding ``(None, common_prefix)`` once for each common prefix
+        (up to and including the delimiter), skipping the keys it contains.
+    """
+    lo = prefix
+    hi = rb_prefix_upper(prefix)
+    while lo is not None:
+        for n in rb_iter_range(root, lo, hi):
+            if delimiter is not None:
+                index = n.key.find(delimiter, len(prefix))
+                if index != -1:
+                    common_prefix = n.key[:index + len(delimiter)]
+                    yield None, common_prefix
+                    # seek past all keys with this common prefix.
+                    lo = rb_prefix_upper(common_prefix)
+                    break
+            yield n, None
+        else:
+            return
+
+
+def rb_iter_pairs_expand(stack):
+    # replace the subtree at the top of the stack with its parts.
+    node, depth = stack.pop()
+    if node.right is not None:
+        stack.append((node.right, depth + 1))
+    stack.append((node, -1))
+    if node.left is not None:
+        stack.append((node.left, depth + 1))
+
+
+def rb_iter_pairs_drain(stack):
+    while stack:
+        node, depth = stack.pop()
+        if depth == -1:
+            yield node
+        else:
+            yield from rb_iter_forward_recursive(node)
+
+
+def rb_iter_pairs(root_a, root_b):
+    """ Walk both trees in order, yielding ``(node_a, node_b)`` pairs,
+        one side is None when the key is only found in the other tree.
+
+        Subtrees (and nodes) shared by both trees can't differ
+        so they're skipped.
+    """
+    # The stacks hold the remaining work with the next item last,
+    # ``(node, depth)`` for a whole subtree, ``(node, -1)`` for a single node.
+    # Expanding the shallowest subtree first keeps both sides at a similar
+    # depth, so shared subtrees line up at the top of both stacks.
+    stack_a = [] if root_a is None else [(root_a, 0)]
+    stack_b = [] if root_b is None else [(root_b, 0)]
+    while stack_a and stack_b:
+        node_a, depth_a = stack_a[-1]
+        node_b, depth_b = stack_b[-1]
+        if node_a is node_b and ((depth_a == -1) == (depth_b == -1)):
+            stack_a.pop()
+            stack_b.pop()
+        elif depth_a != -1 and (depth_b == -1 or depth_a <= depth_b):
+            rb_iter_pairs_expand(stack_a)
+        elif depth_b != -1:
+            rb_iter_pairs_expand(stack_b)
+        else:
+            cmp = key_cmp(node_a.key, node_b.key)
+            if cmp == 0:
+                stack_a.pop()
+                stack_b.pop()
+                yield node_a, node_b
+            elif cmp < 0:
+                stack_a.pop()
+                yield node_a, None
+            else:
+                stack_b.pop()
+                yield None, node_b
+
+    for node_a in rb_iter_pairs_drain(stack_a):
+        yield node_a, None
+    for node_b in rb_iter_pairs_drain(stack_b):
+        yield None, node_b
+
+
+# -----------------------------------------------------------------------------
+# Instrumentation
+#
+# Counting is done by temporarily swapping the module level functions
+# for counting variants while an instrumented tree runs an operation,
+# so trees which aren't instrumented run exactly the same code as before.
+#
+# Note that this isn't thread-safe, operations on other trees
+# which run at the same time will be counted too.
+
+class RBStats:
+    """ Counters for an instrumented tree, see ``instrument_enable``.
+    """
+
+    __slots__ = (
+        "compare",
+        "rotate_left",
+        "rotate_right",
+        "flip_color",
+        "alloc",
+        "free",
+        # depth (nodes on the path to the key, min or max)
+        # -> number of operations with this depth.
+        "depth",
+        "_variants",
+        # while running, the key being measured & the keys of nodes it's compared with.
+        "_depth_key",
+        "_depth_nodes",
+    )
+
+    def __init__(self):
+        self._variants = None
+        self._depth_key = sentinel
+        self._depth_nodes = set()
+        self.reset()
+
+    def reset(self):
+        self.compare = 0
+        self.rotate_left = 0
+        self.rotate_right = 0
+        self.flip_color = 0
+        self.alloc = 0
+        self.free = 0
+        self.depth = {}
+
+    def as_dict(self):
+        return {
+            "compare": self.compare,
+            "rotate_left": self.rotate_left,
+            "rotate_right": self.rotate_right,
+            "flip_color": self.flip_color,
+            "alloc": self.alloc,
+            "free": self.free,
+            "depth": dict(self.depth),
+        }
+
+
+rb_instrument_originals = {
+    fn.__name__: fn for fn in (
+        key_cmp,
+        rb_rotate_left,
+        rb_rotate_right,
+        rb_flip_color,
+        rb_alloc,
+        rb_free,
+    )
+}
+
+
+def rb_instrument_variants(stats):
+    if stats._variants is not None:
+        return stats._variants
+
+    # bind the originals, not the module globals which get replaced.
+    key_cmp_orig = rb_instrument_originals["key_cmp"]
+    rb_rotate_left_orig = rb_instrument_originals["rb_rotate_left"]
+    rb_rotate_right_orig = rb_instrument_originals["rb_rotate_right"]
+    rb_flip_color_orig = rb_instrument_originals["rb_flip_color"]
+    rb_alloc_orig = rb_instrument_originals["rb_alloc"]
+    rb_free_orig = rb_instrument_originals["rb_free"]
+
+    def key_cmp_counted(key1, key2):
+        stats.compare += 1
+        if key1 is stats._depth_key:
+            # ``key2`` belongs to a node on the search path.
+            stats._depth_nodes.add(id(key2))
+        return key_cmp_orig(key1, key2)
+
+    def rb_rotate_left_counted(left):
+        stats.rotate_left += 1
+        return rb_rotate_left_orig(left)
+
+    def rb_rotate_right_counted(right):
+        stats.rotate_right += 1
+        return rb_rotate_right_orig(right)
+
+    def rb_flip_color_counted(node):
+        stats.flip_color += 1
+        rb_flip_color_orig(node)
+
+    def rb_alloc_counted(cls):
+        stats.alloc += 1
+        return rb_alloc_orig(cls)
+
+    def rb_free_counted(node):
+        stats.free += 1
+        rb_free_orig(node)
+
+    stats._variants = {
+        "key_cmp": key_cmp_counted,
+        "rb_rotate_left": rb_rotate_left_counted,
+        "rb_rotate_right": rb_rotate_right_counted,
+        "rb_flip_color": rb_flip_color_counted,
+        "rb_alloc": rb_alloc_counted,
+        "rb_free": rb_free_counted,
+    }
+    return stats._variants
+
+
+# stats of the instrumented operations currently running (innermost last),
+# operations may nest when keys access other instrumented trees.
+rb_instrument_stack = []
+
+
+def rb_instrument_begin(stats):
+    rb_instrument_stack.append(stats)
+    globals().update(rb_instrument_variants(stats))
+
+
+def rb_instrument_end():
+    rb_instrument_stack.pop()
+    if rb_instrument_stack:
+        globals().update(rb_instrument_variants(rb_instrument_stack[-1]))
+    else:
+        globals().update(rb_instrument_originals)
+
+
+def rb_instrument_call(fn, depth, self, key, args, kwargs):
+    stats = self._stats
+    if rb_instrument_stack and rb_instrument_stack[-1] is stats:
+        # called from another method of this tree which is already counted.
+        return fn(self, *args, **kwargs)
+    if depth in {"key", "range"}:
+        # measured while running, from the nodes the key is compared with.
+        if key is not None:
+            stats._depth_key = key
+    elif depth is not None:
+        depth_value = rb_spine_len(self._root, depth)
+    rb_instrument_begin(stats)
+    try:
+        return fn(self, *args, **kwargs)
+    finally:
+        rb_instrument_end()
+        if depth in {"key", "range"}:
+            depth_value = len(stats._depth_nodes)
+            stats._depth_key = sentinel
+            stats._depth_nodes.clear()
+        if depth is not None:
+            stats.depth[depth_value] = stats.depth.get(depth_value, 0) + 1
+
+
+def rb_instrument_method(fn, depth):
+    """ Wrap a tree method so it's counted,
+        ``depth`` is how the depth of the operation is measured:
+
+        - ``"key"``: the nodes the key (the ``key`` argument) is compared with.
+        - ``"range"``: as ``"key"``, for ``lo``, or ``hi`` when ``lo`` is None.
+        - ``"left"`` / ``"right"``: the path to the min / max node.
+        - ``None``: depth isn't recorded.
+    """
+    if depth == "key":
+        # take key by name, so it may be passed as a keyword argument.
+        def wrapper(self, key, *args, **kwargs):
+            return rb_instrument_call(fn, depth, self, key, (key, *args), kwargs)
+    elif depth == "range":
+        def wrapper(self, lo=None, hi=None):
+            key = lo if lo is not None else hi
+            return rb_instrument_call(fn, depth, self, key, (lo, hi), {})
+    else:
+        def wrapper(self, *args, **kwargs):
+            return rb_instrument_call(fn, depth, self, None, args, kwargs)
+
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
+
+# class -> instrumented subclass, created on first use.
+rb_instrument_classes = {}
+
+
+def rb_instrument_class(cls):
+    """ Return a subclass of ``cls`` with the methods in ``cls._instrument_methods``
+        counted, with the same layout so instances can switch between them.
+    """
+    cls_instrument = rb_instrument_classes.get(cls)
+    if cls_instrument is None:
+        namespace = {"__slots__": (), "_instrument_base": cls}
+        for name, depth in cls._instrument_methods:
+            namespace[name] = rb_instrument_method(getattr(cls, name), depth)
+        cls_instrument = type(cls.__name__, (cls,), namespace)
+        cls_instrument.__qualname__ = cls.__qualname__
+        cls_instrument.__module__ = cls.__module__
+        rb_instrument_classes[cls] = cls_instrument
+    return cls_instrument
+
+
 # -----------------------------------------------------------------------------
 # Pythonic Object Oriented Access
 #
@@ -369,10 +995,15 @@ class BNodeMap:
 class BTreeMap:
     __slots__ = (
         "_root",
+        "_stats",
+        # sorted arrays for batch lookups, cleared on modification.
+        "_snapshot",
     )
 
     def __init__(self, data=None):
         self._root = None
+        self._stats = None
+        self._snapshot = None
 
         if data is None:
             pass
@@ -393,23 +1024,34 @@ class BTreeMap:
         else:
             return default
 
+    def floor_key(self, key, default=None):
+        n = rb_floor(self._root, key)
+        if n is not None:
+            return n.key
+        else:
+            return default
+
     def insert(self, key, value):
+        self._snapshot = None
         self._root, node_found = rb_insert_root(self._root, key, BNodeMap)
         node_found.key = key
         node_found.value = value
 
     def remove(self, key):
+        self._snapshot = None
         self._root, node_pop = rb_pop_key(self._root, key)
         if node_pop is None:
             raise KeyError("key not found")
         rb_free(node_pop)
 
     def discard(self, key):
+        self._snapshot = None
         self._root, node_pop = rb_pop_key(self._root, key)
         if node_pop is not None:
             rb_free(node_pop)
 
     def pop_key(self, key, default=sentinel):
+        self._snapshot = None
         self._root, node_pop = rb_pop_key(self._root, key)
         if node_pop is None:
             if default is sentinel:
@@ -419,11 +1061,28 @@ class BTreeMap:
         rb_free(node_pop)
         return value
 
+    def min_item(self, default=sentinel):
+        if self._root is None:
+            if default is sentinel:
+                raise KeyError("empty tree")
+            return default
+        node = rb_min(self._root)
+        return (node.key, node.value)
+
+    def max_item(self, default=sentinel):
+        if self._root is None:
+            if default is sentinel:
+                raise KeyError("empty tree")
+            return default
+        node = rb_max(self._root)
+        return (node.key, node.value)
+
     def pop_min_item(self, default=sentinel):
         if self._root is None:
             if default is sentinel:
                 raise KeyError("pop from empty tree")
             return default
+        self._snapshot = None
         self._root, node_pop = rb_pop_min(self._root)
         item = (node_pop.key, node_pop.value)
         rb_free(node_pop)
@@ -434,6 +1093,7 @@ class BTreeMap:
             if default is sentinel:
                 raise KeyError("pop from empty tree")
             return default
+        self._snapshot = None
         self._root, node_pop = rb_pop_max(self._root)
         item = (node_pop.key, node_pop.value)
         rb_free(node_pop)
@@ -444,6 +1104,7 @@ class BTreeMap:
             if default is sentinel:
                 raise KeyError("pop from empty tree")
             return default
+        self._snapshot = None
         self._root, node_pop = rb_pop_min(self._root)
         value = node_pop.value
         rb_free(node_pop)
@@ -454,12 +1115,38 @@ class BTreeMap:
             if default is sentinel:
                 raise KeyError("pop from empty tree")
             return default
+        self._snapshot = None
         self._root, node_pop = rb_pop_max(self._root)
         value = node_pop.value
         rb_free(node_pop)
         return value
 
+    def remove_range(self, lo=None, hi=None):
+        """ Remove keys from ``lo`` (inclusive) to ``hi`` (exclusive),
+            returning the removed items as a new tree.
+        """
+        self._snapshot = None
+        self._root, root_removed = rb_remove_range(self._root, lo, hi)
+        tree = BTreeMap()
+        tree._root = root_removed
+        return tree
+
+    def truncate_before(self, key):
+        """ Remove keys < ``key``, returning them as a new tree.
+        """
+        return self.remove_range(None, key)
+
+    def truncate_after(self, key):
+        """ Remove keys > ``key``, returning them as a new tree.
+        """
+        self._snapshot = None
+        self._root, root_removed = rb_remove_after(self._root, key)
+        tree = BTreeMap()
+        tree._root = root_removed
+        return tree
+
     def clear(self):
+        self._snapshot = None
         rb_free_recursive(self._root)
         self._root = None
 
@@ -491,20 +1178,138 @@ class BTreeMap:
     def __delitem__(self, key):
         return self.remove(key)
 
+    def __eq__(self, other):
+        if not isinstance(other, BTreeMap):
+            return NotImplemented
+        for node_a, node_b in rb_iter_pairs(self._root, other._root):
+            if node_a is None or node_b is None or node_a.value != node_b.value:
+                return False
+        return True
+
+    # ------------------------------------------------------------------------
+    # Batch Lookups (NumPy)
+    #
+    # For int & float keys, these search a sorted array of the keys
+    # which is rebuilt on first use after the tree is modified.
+
+    def _snapshot_ensure(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            if numpy is None:
+                raise ImportError("numpy is needed for batch lookups")
+            nodes = list(rb_iter_forward_recursive(self._root))
+            keys = [n.key for n in nodes]
+            keys_array = numpy.array(keys, dtype=None if keys else float)
+            if keys_array.dtype.kind not in {"i", "u", "f"}:
+                raise TypeError("batch lookups need int or float keys")
+            if keys_array.dtype.kind == "f" and not all(isinstance(k, float) for k in keys):
+                # mixed int & float keys, converting ints to float may lose precision.
+                raise TypeError("batch lookups need keys to be all int or all float")
+            snapshot = self._snapshot = (keys_array, keys, [n.value for n in nodes])
+        return snapshot
+
+    def _snapshot_query(self, keys):
+        snapshot = self._snapshot_ensure()
+        keys_array = snapshot[0]
+        query = numpy.asarray(keys)
+        if query.dtype.kind not in {"i", "u", "f"}:
+            raise TypeError("batch lookups need an int or float array")
+        if len(keys_array) and numpy.result_type(keys_array, query).kind == "f":
+            # ints are compared as float, only exact up to 2 ** 53.
+            for array in (keys_array, query):
+                if array.dtype.kind in {"i", "u"} and array.size and (
+                        array.min() < -(2 ** 53) or array.max() > 2 ** 53):
+                    raise TypeError("int values beyond 2 ** 53 can't be compared with float exactly")
+        return snapshot, query
+
+    def _snapshot_find(self, keys):
+        (keys_array, keys_list, _), query = self._snapshot_query(keys)
+        index = numpy.searchsorted(keys_array, query, side="left")
+        if len(keys_list) == 0:
+            return index, numpy.zeros(query.shape, dtype=bool)
+        index_clamp = numpy.minimum(index, len(keys_list) - 1)
+        found = (index < len(keys_list)) & (keys_array[index_clamp] == query)
+        return index, found
+
+    def get_many(self, keys, default=None):
+        """ Return a list of values for ``keys`` (a 1D array), matching ``get``.
+        """
+        index, found = self._snapshot_find(keys)
+        values = self._snapshot[2]
+        return [
+            values[i] if is_found else default
+            for i, is_found in zip(index.tolist(), found.tolist())
+        ]
+
+    def contains_many(self, keys):
+        """ Return a boolean array, matching ``key in self`` for each key.
+        """
+        return self._snapshot_find(keys)[1]
+
+    def rank_many(self, keys):
+        """ Return an array with the number of keys less than each key.
+        """
+        (keys_array, _, _), query = self._snapshot_query(keys)
+        return numpy.searchsorted(keys_array, query, side="left")
+
+    def floor_many(self, keys, default=None):
+        """ Return a list of keys for ``keys`` (a 1D array), matching ``floor_key``.
+        """
+        (keys_array, keys_list, _), query = self._snapshot_query(keys)
+        index = numpy.searchsorted(keys_array, query, side="right") - 1
+        return [
+            keys_list[i] if i != -1 else default
+            for i in index.tolist()
+        ]
+
     # ------------------------------------------------------------------------
     # Convenience Helpers
 
+    def diff(self, other):
+        """ Yield ``(kind, key, value_self, value_other)`` for each difference
+            in key order, where kind is ``"added"`` (only in ``other``),
+            ``"removed"`` (only in ``self``) or ``"changed"``.
+            The value of the side missing the key is None.
+        """
+        for node_a, node_b in rb_iter_pairs(self._root, other._root):
+            if node_b is None:
+                yield ("removed", node_a.key, node_a.value, None)
+            elif node_a is None:
+                yield ("added", node_b.key, None, node_b.value)
+            elif node_a.value != node_b.value:
+                yield ("changed", node_a.key, node_a.value, node_b.value)
+
+    def prefix_items(self, prefix, delimiter=None):
+        """ Yield items with ``str`` or ``bytes`` keys starting with ``prefix``.
+            With a ``delimiter``, keys rolled up into common prefixes are skipped
+            (see ``prefix_keys``).
+        """
+        for n, _ in rb_iter_prefix(self._root, prefix, delimiter):
+            if n is not None:
+                yield (n.key, n.value)
+
+    def prefix_keys(self, prefix, delimiter=None):
+        """ Yield ``str`` or ``bytes`` keys starting with ``prefix``.
+            With a ``delimiter``, keys which contain it after the prefix
+            are rolled up, yielding their common prefix once instead.
+        """
+        for n, common_prefix in rb_iter_prefix(self._root, prefix, delimiter):
+            yield common_prefix if n is None else n.key
+
+    def count_prefix(self, prefix, delimiter=None):
+        count = 0
+        for _ in rb_iter_prefix(self._root, prefix, delimiter):
+            count += 1
+        return count
+
     def items(self, reverse=False):
-        for n in rb_iter_dir(self._root, reverse):
-            yield (n.key, n.value)
+        return BTreeMapItemsView(self, reverse=reverse)
 
     def keys(self, reverse=False):
-        for n in rb_iter_dir(self._root, reverse):
-            yield n.key
+        return BTreeMapKeysView(self, reverse=reverse)
 
     def values(self, reverse=False):
-        for n in rb_iter_dir(self._root, reverse):
-            yield n.value
+        return BTreeMapValuesView(self, reverse=reverse)
 
     # ------------------------------------------------------------------------
     # Debugging Functions (use for testing)
@@ -512,6 +1317,130 @@ class BTreeMap:
     def is_valid(self):
         return rb_is_balanced_and_ordered(self._root)
 
+    def shape(self):
+        return rb_shape(self._root)
+
+    # ------------------------------------------------------------------------
+    # Instrumentation
+
+    def instrument_enable(self):
+        if self._stats is None:
+            self.__class__ = rb_instrument_class(type(self))
+            self._stats = RBStats()
+
+    def instrument_disable(self):
+        if self._stats is not None:
+            self.__class__ = self._instrument_base
+            self._stats = None
+
+    def instrument_stats(self):
+        return self._stats
+
+
+class BTreeMapView(collections.abc.MappingView):
+    """ Base class for live views of a ``BTreeMap``,
+        slicing takes keys, ``view[lo:hi]`` is a view of keys from
+        ``lo`` (inclusive) to ``hi`` (exclusive).
+    """
+
+    __slots__ = (
+        "_lo",
+        "_hi",
+        "_reverse",
+    )
+
+    def __init__(self, tree, lo=None, hi=None, reverse=False):
+        self._mapping = tree
+        self._lo = lo
+        self._hi = hi
+        self._reverse = reverse
+
+    def _iter_nodes(self, reverse=False):
+        return rb_iter_range(self._mapping._root, self._lo, self._hi, self._reverse != reverse)
+
+    def _lookup(self, key):
+        if not rb_key_in_range(key, self._lo, self._hi):
+            return None
+        return rb_lookup(self._mapping._root, key)
+
+    def __len__(self):
+        if self._lo is None and self._hi is None:
+            return len(self._mapping)
+        count = 0
+        for _ in self._iter_nodes():
+            count += 1
+        return count
+
+    def __getitem__(self, key_slice):
+        if not isinstance(key_slice, slice):
+            raise TypeError("views can only be sliced by key")
+        if key_slice.step is not None:
+            raise ValueError("slice step is not supported")
+        lo, hi = self._lo, self._hi
+        if key_slice.start is not None:
+            if lo is None or key_cmp(key_slice.start, lo) > 0:
+                lo = key_slice.start
+        if key_slice.stop is not None:
+            if hi is None or key_cmp(key_slice.stop, hi) < 0:
+                hi = key_slice.stop
+        return self.__class__(self._mapping, lo, hi, self._reverse)
+
+    def __repr__(self):
+        return "{:s}({!r})".format(self.__class__.__name__, list(self))
+
+
+class BTreeMapKeysView(BTreeMapView, collections.abc.KeysView):
+
+    __slots__ = ()
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __iter__(self):
+        for n in self._iter_nodes():
+            yield n.key
+
+    def __reversed__(self):
+        for n in self._iter_nodes(reverse=True):
+            yield n.key
+
+
+class BTreeMapValuesView(BTreeMapView, collections.abc.ValuesView):
+
+    __slots__ = ()
+
+    def __contains__(self, value):
+        for n in self._iter_nodes():
+            if n.value is value or n.value == value:
+                return True
+        return False
+
+    def __iter__(self):
+        for n in self._iter_nodes():
+            yield n.value
+
+    def __reversed__(self):
+        for n in self._iter_nodes(reverse=True):
+            yield n.value
+
+
+class BTreeMapItemsView(BTreeMapView, collections.abc.ItemsView):
+
+    __slots__ = ()
+
+    def __contains__(self, item):
+        key, value = item
+        n = self._lookup(key)
+        return n is not None and (n.value is value or n.value == value)
+
+    def __iter__(self):
+        for n in self._iter_nodes():
+            yield (n.key, n.value)
+
+    def __reversed__(self):
+        for n in self._iter_nodes(reverse=True):
+            yield (n.key, n.value)
+
 
 class BNodeSet:
 
@@ -539,10 +1468,12 @@ class BNodeSet:
 class BTreeSet:
     __slots__ = (
         "_root",
+        "_stats",
     )
 
     def __init__(self, data=None):
         self._root = None
+        self._stats = None
 
         if data is None:
             pass
@@ -587,6 +1518,28 @@ class BTreeSet:
         rb_free(node_pop)
         return key
 
+    def remove_range(self, lo=None, hi=None):
+        """ Remove keys from ``lo`` (inclusive) to ``hi`` (exclusive),
+            returning the removed keys as a new tree.
+        """
+        self._root, root_removed = rb_remove_range(self._root, lo, hi)
+        tree = BTreeSet()
+        tree._root = root_removed
+        return tree
+
+    def truncate_before(self, key):
+        """ Remove keys < ``key``, returning them as a new tree.
+        """
+        return self.remove_range(None, key)
+
+    def truncate_after(self, key):
+        """ Remove keys > ``key``, returning them as a new tree.
+        """
+        self._root, root_removed = rb_remove_after(self._root, key)
+        tree = BTreeSet()
+        tree._root = root_removed
+        return tree
+
     def clear(self):
         rb_free_recursive(self._root)
         self._root = None
@@ -618,11 +1571,625 @@ class BTreeSet:
     def __delitem__(self, key):
         return self.remove(key)
 
+    def __eq__(self, other):
+        if not isinstance(other, BTreeSet):
+            return NotImplemented
+        for node_a, node_b in rb_iter_pairs(self._root, other._root):
+            if node_a is None or node_b is None:
+                return False
+        return True
+
     # ------------------------------------------------------------------------
     # Convenience Helpers
 
+    def diff(self, other):
+        """ Yield ``(kind, key)`` for each difference in key order,
+            where kind is ``"added"`` (only in ``other``)
+            or ``"removed"`` (only in ``self``).
+        """
+        for node_a, node_b in rb_iter_pairs(self._root, other._root):
+            if node_b is None:
+                yield ("removed", node_a.key)
+            elif node_a is None:
+                yield ("added", node_b.key)
+
+    def prefix_keys(self, prefix, delimiter=None):
+        """ Yield ``str`` or ``bytes`` keys starting with ``prefix``.
+            With a ``delimiter``, keys which contain it after the prefix
+            are rolled up, yielding their common prefix once instead.
+        """
+        for n, common_prefix in rb_iter_prefix(self._root, prefix, delimiter):
+            yield common_prefix if n is None else n.key
+
+    def count_prefix(self, prefix, delimiter=None):
+        count = 0
+        for _ in rb_iter_prefix(self._root, prefix, delimiter):
+            count += 1
+        return count
+
     # ------------------------------------------------------------------------
     # Debugging Functions (use for testing)
 
     def is_valid(self):
         return rb_is_balanced_and_ordered(self._root)
+
+    def shape(self):
+        return rb_shape(self._root)
+
+    # ------------------------------------------------------------------------
+    # Instrumentation
+
+    def instrument_enable(self):
+        if self._stats is None:
+            self.__class__ = rb_instrument_class(type(self))
+            self._stats = RBStats()
+
+    def instrument_disable(self):
+        if self._stats is not None:
+            self.__class__ = self._instrument_base
+            self._stats = None
+
+    def instrument_stats(self):
+        return self._stats
+
+
+# ``truncate_before`` isn't listed as it calls ``remove_range``.
+BTreeMap._instrument_methods = (
+    ("get", "key"),
+    ("insert", "key"),
+    ("remove", "key"),
+    ("discard", "key"),
+    ("pop_key", "key"),
+    ("pop_min_item", "left"),
+    ("pop_max_item", "right"),
+    ("pop_min_value", "left"),
+    ("pop_max_value", "right"),
+    ("remove_range", "range"),
+    ("truncate_after", "key"),
+    ("clear", None),
+    ("__contains__", "key"),
+    ("__getitem__", "key"),
+)
+
+BTreeSet._instrument_methods = (
+    ("add", "key"),
+    ("remove", "key"),
+    ("discard", "key"),
+    ("pop_min_key", "left"),
+    ("pop_max_key", "right"),
+    ("remove_range", "range"),
+    ("truncate_after", "key"),
+    ("clear", None),
+    ("__contains__", "key"),
+)
+
+
+# -----------------------------------------------------------------------------
+# Multiple Trees
+
+def merge_iter(*trees, reverse=False, lo=None, hi=None, dedupe=None):
+    """ Lazily merge trees in key order, yielding ``(key, value)`` items
+        for ``BTreeMap`` or keys for ``BTreeSet`` (trees can't be mixed).
+        Keys are limited to the range ``lo`` (inclusive) to ``hi`` (exclusive).
+
+        ``dedupe`` is the policy for keys found in multiple trees:
+
+        - ``None``: yield every entry, in the order the trees are passed in.
+        - ``"first"`` / ``"last"``: yield the entry from the first / last tree.
+        - A callable, taking a list of the entries, returning the entry to yield.
+    """
+    if all(isinstance(tree, BTreeMap) for tree in trees):
+        def node_entry(n):
+            return (n.key, n.value)
+    elif all(isinstance(tree, BTreeSet) for tree in trees):
+        def node_entry(n):
+            return n.key
+    else:
+        raise TypeError("trees must all be BTreeMap or all be BTreeSet")
+
+    if not (dedupe is None or callable(dedupe) or dedupe in ("first", "last")):
+        raise ValueError("unknown dedupe policy: " + repr(dedupe))
+
+    # arguments are checked above, iteration is done by the generator.
+    return merge_iter_impl(trees, reverse, lo, hi, dedupe, node_entry)
+
+
+def merge_iter_impl(trees, reverse, lo, hi, dedupe, node_entry):
+    node_key = operator.attrgetter("key")
+    nodes = heapq.merge(
+        *(rb_iter_range(tree._root, lo, hi, reverse) for tree in trees),
+        key=node_key,
+        reverse=reverse,
+    )
+    if dedupe is None:
+        for n in nodes:
+            yield node_entry(n)
+        return
+
+    # ties are kept in the order trees are passed in.
+    for _, group in itertools.groupby(nodes, key=node_key):
+        if dedupe == "first":
+            yield node_entry(next(group))
+        elif dedupe == "last":
+            for n in group:
+                pass
+            yield node_entry(n)
+        else:
+            yield dedupe([node_entry(n) for n in group])
+
+
+# -----------------------------------------------------------------------------
+# Durable Storage
+#
+# - DurableBTreeMap
+#
+# Files in the directory:
+#
+# - ``snapshot``: all items (sorted), written on compaction.
+# - ``log``: changes made since the snapshot was written.
+#
+# Both use the same framing, a header of the payload length & CRC32
+# followed by a pickled payload, so a torn write at the end of the log
+# (from a crash) is detected and dropped.
+#
+# Replaying the log is idempotent (each record sets or removes a key),
+# so a crash after a new snapshot is written but before the log is
+# truncated only costs replaying records which are already applied.
+
+DURABLE_FRAME = struct.Struct("<II")
+
+
+def durable_frame_pack(data):
+    payload = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    return DURABLE_FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def durable_frame_unpack_iter(buf):
+    # yield (data, offset_end) for each complete frame,
+    # stopping at the first torn or corrupt frame.
+    offset = 0
+    while offset + DURABLE_FRAME.size <= len(buf):
+        size, crc = DURABLE_FRAME.unpack_from(buf, offset)
+        payload_start = offset + DURABLE_FRAME.size
+        payload_end = payload_start + size
+        if payload_end > len(buf):
+            return
+        payload = buf[payload_start:payload_end]
+        if zlib.crc32(payload) != crc:
+            return
+        yield pickle.loads(payload), payload_end
+        offset = payload_end
+
+
+def durable_fsync_dir(path):
+    # needed for a rename to be durable, not supported on all platforms.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class DurableBTreeMap(BTreeMap):
+    """ A ``BTreeMap`` kept in the directory ``path``,
+        mutations are appended to a log which is compacted into a snapshot
+        once it grows past ``compact_size`` bytes.
+
+        Mutations are written in groups of ``batch_size``,
+        call ``flush`` (or ``close``) to write any pending mutations.
+        When ``fsync`` is enabled, each group is synced to disk.
+    """
+
+    __slots__ = (
+        "_path",
+        "_log",
+        "_log_size",
+        "_pending",
+        "_batch_size",
+        "_fsync",
+        "_compact_size",
+    )
+
+    def __init__(self, path, *, batch_size=1, fsync=True, compact_size=1 << 20):
+        BTreeMap.__init__(self)
+        self._path = path
+        self._log = None
+        self._log_size = 0
+        self._pending = []
+        self._batch_size = batch_size
+        self._fsync = fsync
+        self._compact_size = compact_size
+
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _filepath(self, name):
+        return os.path.join(self._path, name)
+
+    def _load(self):
+        filepath_snapshot = self._filepath("snapshot")
+        if os.path.exists(filepath_snapshot):
+            with open(filepath_snapshot, "rb") as fh:
+                buf = fh.read()
+            frames = list(durable_frame_unpack_iter(buf))
+            if len(frames) != 1 or frames[0][1] != len(buf):
+                raise ValueError("corrupt snapshot: " + repr(filepath_snapshot))
+            nodes = []
+            for key, value in frames[0][0]:
+                node = BNodeMap()
+                node.key = key
+                node.value = value
+                nodes.append(node)
+            self._root = rb_build_sorted(nodes)
+
+        filepath_log = self._filepath("log")
+        log_size = 0
+        if os.path.exists(filepath_log):
+            with open(filepath_log, "rb") as fh:
+                buf = fh.read()
+            for (op, *args), log_size in durable_frame_unpack_iter(buf):
+                getattr(BTreeMap, op)(self, *args)
+            if log_size != len(buf):
+                # drop the torn tail.
+                with open(filepath_log, "r+b") as fh:
+                    fh.truncate(log_size)
+        self._log = open(filepath_log, "ab")
+        self._log_size = log_size
+
+    def _log_pack(self, *record):
+        # called by mutations before the tree is modified.
+        self._ensure_open()
+        return durable_frame_pack(record)
+
+    def _ensure_open(self):
+        if self._log is None:
+            raise ValueError("I/O operation on closed DurableBTreeMap")
+
+    def _log_append(self, frame):
+        # ``frame`` is packed before the tree is modified,
+        # so a value which can't be pickled leaves the tree unchanged.
+        self._pending.append(frame)
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        self._ensure_open()
+        if self._pending:
+            data = b"".join(self._pending)
+            self._pending.clear()
+            self._log.write(data)
+            self._log.flush()
+            if self._fsync:
+                os.fsync(self._log.fileno())
+            self._log_size += len(data)
+        if self._log_size >= self._compact_size:
+            self.compact()
+
+    def compact(self):
+        """ Write all items to a new snapshot and empty the log.
+        """
+        self._ensure_open()
+        if self._pending:
+            # ensure the log is never behind the snapshot.
+            self._log.write(b"".join(self._pending))
+            self._pending.clear()
+            self._log.flush()
+
+        filepath_snapshot = self._filepath("snapshot")
+        filepath_snapshot_tmp = filepath_snapshot + ".tmp"
+        with open(filepath_snapshot_tmp, "wb") as fh:
+            fh.write(durable_frame_pack([
+                (n.key, n.value) for n in rb_iter_forward_recursive(self._root)
+            ]))
+            fh.flush()
+            if self._fsync:
+                os.fsync(fh.fileno())
+        os.replace(filepath_snapshot_tmp, filepath_snapshot)
+        if self._fsync:
+            durable_fsync_dir(self._path)
+
+        self._log.truncate(0)
+        if self._fsync:
+            os.fsync(self._log.fileno())
+        self._log_size = 0
+
+    def close(self):
+        if self._log is not None:
+            self.flush()
+            self._log.close()
+            self._log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # ------------------------------------------------------------------------
+    # Logged Mutations
+
+    def _pop_item_logged(self, node, default, pop_fn):
+        if node is None:
+            if default is sentinel:
+                raise KeyError("pop from empty tree")
+            return default
+        item = (node.key, node.value)
+        frame = self._log_pack("discard", item[0])
+        pop_fn(self)
+        self._log_append(frame)
+        return item
+
+    def insert(self, key, value):
+        frame = self._log_pack("insert", key, value)
+        BTreeMap.insert(self, key, value)
+        self._log_append(frame)
+
+    def remove(self, key):
+        frame = self._log_pack("discard", key)
+        BTreeMap.remove(self, key)
+        self._log_append(frame)
+
+    def discard(self, key):
+        frame = self._log_pack("discard", key)
+        if BTreeMap.pop_key(self, key, sentinel) is not sentinel:
+            self._log_append(frame)
+
+    def pop_key(self, key, default=sentinel):
+        frame = self._log_pack("discard", key)
+        value = BTreeMap.pop_key(self, key, sentinel)
+        if value is sentinel:
+            if default is sentinel:
+                raise KeyError("key not found")
+            return default
+        self._log_append(frame)
+        return value
+
+    def pop_min_item(self, default=sentinel):
+        return self._pop_item_logged(rb_min(self._root), default, BTreeMap.pop_min_item)
+
+    def pop_max_item(self, default=sentinel):
+        return self._pop_item_logged(rb_max(self._root), default, BTreeMap.pop_max_item)
+
+    def pop_min_value(self, default=sentinel):
+        node = rb_min(self._root)
+        if node is None and default is not sentinel:
+            return default
+        return self._pop_item_logged(node, sentinel, BTreeMap.pop_min_item)[1]
+
+    def pop_max_value(self, default=sentinel):
+        node = rb_max(self._root)
+        if node is None and default is not sentinel:
+            return default
+        return self._pop_item_logged(node, sentinel, BTreeMap.pop_max_item)[1]
+
+    def remove_range(self, lo=None, hi=None):
+        frame = self._log_pack("remove_range", lo, hi)
+        tree = BTreeMap.remove_range(self, lo, hi)
+        self._log_append(frame)
+        return tree
+
+    def truncate_before(self, key):
+        return self.remove_range(None, key)
+
+    def truncate_after(self, key):
+        frame = self._log_pack("truncate_after", key)
+        tree = BTreeMap.truncate_after(self, key)
+        self._log_append(frame)
+        return tree
+
+    def clear(self):
+        frame = self._log_pack("clear")
+        BTreeMap.clear(self)
+        self._log_append(frame)
+
+
+# -----------------------------------------------------------------------------
+# Caches
+#
+# - TTLCache
+# - LRUCache
+#
+# A ``dict`` for lookups, paired with a ``BTreeMap`` index in eviction order
+# (mapping an ordered index key to the cache key), so the next entry
+# to evict is always the minimum of the index.
+
+class BTreeCache:
+    """ Base class for caches, holding at most ``maxsize`` entries.
+
+        Subclasses define ``_index_key_next()``, returning the index key
+        for an entry which is set (or used) now, the smallest is evicted first.
+    """
+
+    __slots__ = (
+        # key -> [value, index_key]
+        "_data",
+        # index_key -> key
+        "_index",
+        "_tick",
+        "maxsize",
+        "hits",
+        "misses",
+        "evictions",
+    )
+
+    def __init__(self, maxsize):
+        self._data = {}
+        self._index = BTreeMap()
+        self._tick = 0
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry_is_expired(self, entry):
+        return False
+
+    def _entry_reindex(self, entry, index_key):
+        key = self._index.pop_key(entry[1])
+        self._index.insert(index_key, key)
+        entry[1] = index_key
+
+    def _entry_hit(self, entry):
+        pass
+
+    def _entry_get(self, key):
+        # returns the entry, removing it when expired.
+        entry = self._data.get(key)
+        if entry is not None and self._entry_is_expired(entry):
+            self._index.remove(entry[1])
+            del self._data[key]
+            self.evictions += 1
+            entry = None
+        return entry
+
+    def _set(self, key, value, index_key):
+        entry = self._data.get(key)
+        if entry is None:
+            self._data[key] = [value, index_key]
+            self._index.insert(index_key, key)
+            while len(self._data) > self.maxsize:
+                self._data.pop(self._index.pop_min_value())
+                self.evictions += 1
+        else:
+            entry[0] = value
+            self._entry_reindex(entry, index_key)
+
+    def _touch(self, key, index_key):
+        entry = self._entry_get(key)
+        if entry is None:
+            return False
+        self._entry_reindex(entry, index_key)
+        return True
+
+    def set(self, key, value):
+        self._set(key, value, self._index_key_next())
+
+    def get(self, key, default=None):
+        entry = self._entry_get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._entry_hit(entry)
+        return entry[0]
+
+    def touch(self, key):
+        """ Move the key to the end of the eviction order,
+            returning False when it's not found.
+        """
+        return self._touch(key, self._index_key_next())
+
+    def pop(self, key, default=sentinel):
+        entry = self._entry_get(key)
+        if entry is None:
+            if default is sentinel:
+                raise KeyError(repr(key))
+            return default
+        del self._data[key]
+        self._index.remove(entry[1])
+        return entry[0]
+
+    def clear(self):
+        self._data.clear()
+        self._index.clear()
+
+    def stats_reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._entry_get(key) is not None
+
+    def __getitem__(self, key):
+        entry = self._entry_get(key)
+        if entry is None:
+            self.misses += 1
+            raise KeyError(repr(key))
+        self.hits += 1
+        self._entry_hit(entry)
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+
+class TTLCache(BTreeCache):
+    """ Cache where entries expire ``ttl`` seconds after they're set (or touched),
+        when full, the entries closest to expiring are evicted first.
+
+        Expired entries are removed by ``expire``, which runs on ``set``,
+        ``len()`` may include expired entries which haven't been removed yet.
+    """
+
+    __slots__ = (
+        "ttl",
+        "_timer",
+    )
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        BTreeCache.__init__(self, maxsize)
+        self.ttl = ttl
+        self._timer = timer
+
+    def _index_key_next(self, ttl=None):
+        # the tick ensures index keys are unique and never compares cache keys.
+        self._tick += 1
+        return (self._timer() + (self.ttl if ttl is None else ttl), self._tick)
+
+    def _entry_is_expired(self, entry):
+        return entry[1][0] <= self._timer()
+
+    def expire(self, now=None):
+        """ Remove all entries expired at ``now``, returning the number removed.
+        """
+        if now is None:
+            now = self._timer()
+        index = self._index
+        count = 0
+        while True:
+            item = index.min_item(None)
+            if item is None or item[0][0] > now:
+                break
+            index.pop_min_item()
+            del self._data[item[1]]
+            count += 1
+        self.evictions += count
+        return count
+
+    def set(self, key, value, ttl=None):
+        """ Set the value, expiring after ``ttl`` seconds (defaults to ``self.ttl``).
+        """
+        self.expire()
+        self._set(key, value, self._index_key_next(ttl))
+
+    def touch(self, key, ttl=None):
+        """ Restart the key's expiry time (``ttl`` defaults to ``self.ttl``),
+            returning False when it's not found.
+        """
+        return self._touch(key, self._index_key_next(ttl))
+
+
+class LRUCache(BTreeCache):
+    """ Cache which evicts the least recently used entries when full.
+    """
+
+    __slots__ = ()
+
+    def _index_key_next(self):
+        self._tick += 1
+        return self._tick
+
+    def _entry_hit(self, entry):
+        self._entry_reindex(entry, self._index_key_next())
@@ -2,8 +2,16 @@
 
 import btree_mini
 
+import os
+import pickle
+import tempfile
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 # -----------------------------------------------------------------------------
 # BTreeMap
@@ -190,6 +198,733 @@ class TestMapPopMinMax(unittest.TestCase, TestMapPopMinMax_Helper):
         self.assertSet(set(range(100)), seed=1)
 
 
+class TestMapCompare(unittest.TestCase):
+
+    def test_eq(self):
+        data = {i: -i for i in range(100)}
+        r = btree_mini.BTreeMap(data)
+        self.assertEqual(r, btree_mini.BTreeMap(reversed(list(data.items()))))
+        self.assertEqual(r, r)
+        data[50] = 50
+        self.assertNotEqual(r, btree_mini.BTreeMap(data))
+        del data[50]
+        self.assertNotEqual(r, btree_mini.BTreeMap(data))
+        self.assertNotEqual(r, dict(data))
+
+    def test_diff(self):
+        r_a = btree_mini.BTreeMap({i: i for i in range(0, 10)})
+        r_b = btree_mini.BTreeMap({i: i for i in range(5, 15)})
+        r_b[6] = -6
+        diff = list(r_a.diff(r_b))
+        self.assertEqual(
+            [("removed", i, i, None) for i in range(0, 5)] +
+            [("changed", 6, 6, -6)] +
+            [("added", i, None, i) for i in range(10, 15)],
+            diff)
+        self.assertEqual([], list(r_a.diff(r_a.copy())))
+
+    def test_diff_shared(self):
+        r_a = btree_mini.BTreeMap({i: i for i in range(100)})
+        r_b = btree_mini.BTreeMap()
+        # share both children of the root.
+        r_b._root = r_a._root.copy()
+        r_b._root.value = None
+        self.assertEqual(
+            [("changed", r_a._root.key, r_a._root.value, None)],
+            list(r_a.diff(r_b)))
+
+
+class TestMapViews(unittest.TestCase):
+
+    def test_live(self):
+        r = btree_mini.BTreeMap({i: -i for i in range(10)})
+        keys = r.keys()
+        self.assertEqual(10, len(keys))
+        r[10] = -10
+        self.assertEqual(11, len(keys))
+        self.assertIn(10, keys)
+        self.assertNotIn(11, keys)
+        self.assertIn((10, -10), r.items())
+        self.assertNotIn((10, 10), r.items())
+        self.assertIn(-10, r.values())
+
+    def test_reversed(self):
+        r = btree_mini.BTreeMap({i: -i for i in range(10)})
+        self.assertEqual(list(reversed(range(10))), list(reversed(r.keys())))
+        self.assertEqual(list(reversed(range(10))), list(r.keys(reverse=True)))
+        self.assertEqual(list(range(10)), list(reversed(r.keys(reverse=True))))
+        self.assertEqual([-i for i in reversed(range(10))], list(reversed(r.values())))
+
+    def test_slice(self):
+        r = btree_mini.BTreeMap({i: -i for i in range(100)})
+        keys = r.keys()[10:20]
+        self.assertEqual(list(range(10, 20)), list(keys))
+        self.assertEqual(list(reversed(range(10, 20))), list(reversed(keys)))
+        self.assertEqual(10, len(keys))
+        self.assertIn(10, keys)
+        self.assertNotIn(20, keys)
+        self.assertNotIn(5, keys)
+        self.assertEqual(list(range(15, 20)), list(keys[15:]))
+        self.assertEqual(list(range(10, 12)), list(keys[:12]))
+        self.assertEqual(list(range(95, 100)), list(r.keys()[95:200]))
+        self.assertEqual([(i, -i) for i in range(0, 3)], list(r.items()[:3]))
+        self.assertEqual([], list(r.values()[50:50]))
+
+    def test_set_operators(self):
+        r_a = btree_mini.BTreeMap({i: i for i in range(0, 10)})
+        r_b = btree_mini.BTreeMap({i: i for i in range(5, 15)})
+        self.assertEqual(set(range(5, 10)), r_a.keys() & r_b.keys())
+        self.assertEqual(set(range(0, 15)), r_a.keys() | r_b.keys())
+        self.assertEqual(set(range(0, 5)), r_a.keys() - r_b.keys())
+        self.assertEqual({1, 2}, r_a.keys() & {1, 2, 100})
+        self.assertEqual({(5, 5)}, r_a.items() & {(5, 5), (6, -6)})
+        self.assertTrue(r_a.keys()[2:4] <= r_a.keys())
+
+
+class TestMapPrefix(unittest.TestCase):
+
+    keys = (
+        "a",
+        "t1/b1/o1",
+        "t1/b1/o2",
+        "t1/b2/o1",
+        "t1/x",
+        "t1\uffff",
+        "t2/b1/o1",
+        "t2/b1/o2",
+    )
+
+    def test_prefix(self):
+        r = btree_mini.BTreeMap({k: i for i, k in enumerate(self.keys)})
+        for prefix in ("", "t", "t1", "t1/", "t1/b1/", "t1/b1/o1", "t3", "a", "\uffff"):
+            expect = [k for k in self.keys if k.startswith(prefix)]
+            self.assertEqual(expect, list(r.prefix_keys(prefix)))
+            self.assertEqual([(k, r[k]) for k in expect], list(r.prefix_items(prefix)))
+            self.assertEqual(len(expect), r.count_prefix(prefix))
+
+    def test_delimiter(self):
+        r = btree_mini.BTreeMap({k: i for i, k in enumerate(self.keys)})
+        self.assertEqual(["a", "t1/", "t1\uffff", "t2/"], list(r.prefix_keys("", "/")))
+        self.assertEqual(["t1/b1/", "t1/b2/", "t1/x"], list(r.prefix_keys("t1/", "/")))
+        self.assertEqual([("t1/x", 4)], list(r.prefix_items("t1/", "/")))
+        self.assertEqual(3, r.count_prefix("t1/", "/"))
+
+    def test_bytes(self):
+        keys = [b"a\xff", b"a\xff\x00", b"a\xff\xff", b"b"]
+        r = btree_mini.BTreeSet(keys)
+        self.assertEqual(keys[:3], list(r.prefix_keys(b"a")))
+        self.assertEqual(keys[:3], list(r.prefix_keys(b"a\xff")))
+        self.assertEqual(keys[2:3], list(r.prefix_keys(b"a\xff\xff")))
+        self.assertEqual([b"a\xff"], list(r.prefix_keys(b"a", b"\xff")))
+        self.assertEqual(4, r.count_prefix(b""))
+        with self.assertRaises(TypeError):
+            list(r.prefix_keys(1))
+
+
+class TestMapRemoveRange(unittest.TestCase):
+
+    def assertRemoveRange(self, total, lo, hi):
+        r = btree_mini.BTreeMap({i: -i for i in range(total)})
+        r_removed = r.remove_range(lo, hi)
+        keys_removed = [
+            i for i in range(total)
+            if (lo is None or i >= lo) and (hi is None or i < hi)
+        ]
+        self.assertEqual(keys_removed, list(r_removed.keys()))
+        self.assertEqual([i for i in range(total) if i not in keys_removed], list(r.keys()))
+        self.assertEqual(r.is_valid(), True)
+        self.assertEqual(r_removed.is_valid(), True)
+        # ensure both trees can still be modified.
+        r[total] = 0
+        r_removed[-1] = 0
+        r.discard(total // 2)
+        self.assertEqual(r.is_valid(), True)
+        self.assertEqual(r_removed.is_valid(), True)
+
+    def test_ranges(self):
+        for total in (0, 1, 2, 10, 100):
+            for lo in (None, -1, 0, 1, 5, total // 2, total - 1, total):
+                for hi in (None, -1, 0, 3, total // 2, total, total + 1):
+                    self.assertRemoveRange(total, lo, hi)
+
+    def test_truncate(self):
+        r = btree_mini.BTreeMap({i: -i for i in range(100)})
+        self.assertEqual(list(range(10)), list(r.truncate_before(10).keys()))
+        self.assertEqual(list(range(91, 100)), list(r.truncate_after(90).keys()))
+        self.assertEqual(list(range(10, 91)), list(r.keys()))
+        self.assertEqual(r.is_valid(), True)
+
+    def test_set(self):
+        r = btree_mini.BTreeSet(range(100))
+        self.assertEqual(list(range(20, 30)), list(r.remove_range(20, 30)))
+        self.assertEqual(list(range(50, 100)), list(r.truncate_after(49)))
+        self.assertEqual(list(range(0, 20)) + list(range(30, 50)), list(r))
+        self.assertEqual(r.is_valid(), True)
+
+
+class TestMapFloor(unittest.TestCase):
+
+    def test_min_max_item(self):
+        r = btree_mini.BTreeMap({i: -i for i in range(10)})
+        self.assertEqual((0, 0), r.min_item())
+        self.assertEqual((9, -9), r.max_item())
+        self.assertEqual(10, len(r))
+        self.assertEqual(None, btree_mini.BTreeMap().min_item(None))
+        with self.assertRaises(KeyError):
+            btree_mini.BTreeMap().max_item()
+
+    def test_floor_key(self):
+        r = btree_mini.BTreeMap({i: -i for i in range(0, 100, 10)})
+        self.assertEqual(None, r.floor_key(-1))
+        self.assertEqual(0, r.floor_key(0))
+        self.assertEqual(50, r.floor_key(55))
+        self.assertEqual(90, r.floor_key(1000))
+        self.assertEqual("", btree_mini.BTreeMap().floor_key(1, ""))
+
+
+@unittest.skipIf(numpy is None, "numpy not found")
+class TestMapBatch(unittest.TestCase):
+
+    def assertMatchScalar(self, r, query):
+        query_array = numpy.array(query)
+        self.assertEqual([r.get(k) for k in query], r.get_many(query_array))
+        self.assertEqual([k in r for k in query], r.contains_many(query_array).tolist())
+        self.assertEqual([r.floor_key(k) for k in query], r.floor_many(query_array))
+        self.assertEqual(
+            [sum(1 for k_other in r.keys() if k_other < k) for k in query],
+            r.rank_many(query_array).tolist())
+
+    def test_int(self):
+        r = btree_mini.BTreeMap({i: -i for i in range(0, 100, 3)})
+        self.assertMatchScalar(r, list(range(-5, 105)))
+
+    def test_float(self):
+        r = btree_mini.BTreeMap({i / 4: i for i in range(100)})
+        self.assertMatchScalar(r, [i / 8 for i in range(-10, 220)])
+
+    def test_empty(self):
+        self.assertMatchScalar(btree_mini.BTreeMap(), [1, 2, 3])
+
+    def test_invalidate(self):
+        r = btree_mini.BTreeMap({i: i for i in range(10)})
+        query = numpy.arange(20)
+        self.assertMatchScalar(r, query.tolist())
+        r[15] = 15
+        del r[5]
+        self.assertMatchScalar(r, query.tolist())
+        r.pop_min_item()
+        self.assertMatchScalar(r, query.tolist())
+
+    def test_precision(self):
+        # mixed int & float keys.
+        r = btree_mini.BTreeMap({2 ** 53 + 1: "x", 0.5: "y"})
+        with self.assertRaises(TypeError):
+            r.get_many(numpy.array([2 ** 53 + 1]))
+
+        # large int keys queried with floats.
+        r = btree_mini.BTreeMap({2 ** 53 + 1: "x"})
+        self.assertEqual(None, r.get(2.0 ** 53))
+        with self.assertRaises(TypeError):
+            r.get_many(numpy.array([2.0 ** 53]))
+        with self.assertRaises(TypeError):
+            r.contains_many(numpy.array([2.0 ** 53]))
+        self.assertMatchScalar(r, [2 ** 53, 2 ** 53 + 1, 2 ** 53 + 2])
+
+        # float keys queried with large ints.
+        r = btree_mini.BTreeMap({2.0 ** 53: "x"})
+        with self.assertRaises(TypeError):
+            r.contains_many(numpy.array([2 ** 53 + 1]))
+        self.assertMatchScalar(r, [2.0 ** 53, 1.5])
+        self.assertMatchScalar(r, [2 ** 53, -(2 ** 53)])
+
+    def test_non_numeric(self):
+        r = btree_mini.BTreeMap({"a": 1})
+        with self.assertRaises(TypeError):
+            r.contains_many(numpy.array(["a"]))
+
+
+class TestMapInstrument(unittest.TestCase):
+
+    def test_counters(self):
+        r = btree_mini.BTreeMap()
+        r.instrument_enable()
+        for i in range(100):
+            r[i] = i
+        stats = r.instrument_stats()
+        self.assertEqual(100, stats.alloc)
+        self.assertEqual(100, sum(stats.depth.values()))
+        self.assertGreater(stats.rotate_left, 0)
+        self.assertGreater(stats.flip_color, 0)
+
+        r.pop_min_item()
+        r.remove(50)
+        self.assertEqual(2, stats.free)
+        r.clear()
+        self.assertEqual(100, stats.free)
+
+        stats.reset()
+        self.assertEqual(0, stats.compare)
+        self.assertEqual({}, stats.depth)
+
+    def test_depth(self):
+        r = btree_mini.BTreeMap({i: i for i in range(100)})
+        r.instrument_enable()
+        stats = r.instrument_stats()
+        for i in range(-1, 101):
+            # nodes on the search path.
+            depth = 0
+            node = r._root
+            while node is not None:
+                depth += 1
+                if node.key == i:
+                    break
+                node = node.left if i < node.key else node.right
+            stats.reset()
+            r.get(i)
+            self.assertEqual({depth: 1}, stats.depth)
+        for i in range(0, 100, 2):
+            height = r.shape()["height"]
+            stats.reset()
+            r.remove(i)
+            (depth,) = stats.depth
+            # rotations while removing may add a node for each level.
+            self.assertLessEqual(depth, height * 2)
+        stats.reset()
+        depth = btree_mini.rb_spine_len(r._root, "left")
+        r.pop_min_item()
+        self.assertEqual({depth: 1}, stats.depth)
+
+    def test_key_compare_calls(self):
+        calls = [0]
+
+        class Key:
+            __slots__ = ("value",)
+
+            def __init__(self, value):
+                self.value = value
+
+            def __eq__(self, other):
+                calls[0] += 1
+                return self.value == other.value
+
+            def __lt__(self, other):
+                calls[0] += 1
+                return self.value < other.value
+
+        r = btree_mini.BTreeMap([(Key(i), i) for i in range(100)])
+        calls[0] = 0
+        r.get(Key(25))
+        calls_expect = calls[0]
+        r.instrument_enable()
+        calls[0] = 0
+        r.get(Key(25))
+        self.assertEqual(calls_expect, calls[0])
+
+    def test_nested(self):
+        r_other = btree_mini.BTreeMap({i: i for i in range(10)})
+
+        class Key:
+            __slots__ = ("value",)
+            nested = False
+
+            def __init__(self, value):
+                self.value = value
+
+            def __eq__(self, other):
+                if Key.nested:
+                    r_other.get(5)
+                return self.value == other.value
+
+            def __lt__(self, other):
+                return self.value < other.value
+
+        r = btree_mini.BTreeMap([(Key(i), i) for i in range(100)])
+        r.instrument_enable()
+        r.get(Key(25))
+        compare_expect = r.instrument_stats().compare
+        r.instrument_stats().reset()
+
+        Key.nested = True
+        r_other.instrument_enable()
+        r.get(Key(25))
+        self.assertEqual(compare_expect, r.instrument_stats().compare)
+        self.assertGreater(r_other.instrument_stats().compare, 0)
+        self.assertIs(btree_mini.key_cmp, btree_mini.rb_instrument_originals["key_cmp"])
+
+    def test_disable(self):
+        r = btree_mini.BTreeMap({i: i for i in range(10)})
+        r.instrument_enable()
+        self.assertEqual(r[5], 5)
+        self.assertIsInstance(r, btree_mini.BTreeMap)
+        r.instrument_disable()
+        self.assertIsNone(r.instrument_stats())
+        self.assertIs(type(r), btree_mini.BTreeMap)
+        self.assertIs(btree_mini.key_cmp, btree_mini.rb_instrument_originals["key_cmp"])
+
+    def test_keywords(self):
+        r = btree_mini.BTreeMap({i: i for i in range(10)})
+        r.instrument_enable()
+        self.assertEqual(3, r.get(key=3))
+        r.insert(key=20, value=2)
+        self.assertEqual(2, r.pop_key(key=20))
+        r.truncate_after(key=8)
+        self.assertEqual(list(range(9)), list(r.keys()))
+        self.assertEqual(4, sum(r.instrument_stats().depth.values()))
+
+        r_set = btree_mini.BTreeSet(range(10))
+        r_set.instrument_enable()
+        r_set.add(key=20)
+        r_set.discard(key=3)
+        self.assertEqual([0, 1, 2, 4, 5, 6, 7, 8, 9, 20], list(r_set))
+
+    def test_range_depth(self):
+        r = btree_mini.BTreeMap({i: i for i in range(100)})
+        # the root & a leaf have different depths.
+        key_root = r._root.key
+        r.instrument_enable()
+        r.remove_range(hi=99, lo=key_root)
+        self.assertEqual({1: 1}, r.instrument_stats().depth)
+
+    def test_truncate(self):
+        r = btree_mini.BTreeMap({i: i for i in range(100)})
+        r.instrument_enable()
+        r.truncate_before(10)
+        self.assertEqual(1, sum(r.instrument_stats().depth.values()))
+        self.assertGreater(r.instrument_stats().compare, 0)
+
+    def test_subclass(self):
+        class BTreeMapSub(btree_mini.BTreeMap):
+            pass
+
+        r = BTreeMapSub({i: i for i in range(10)})
+        r.instrument_enable()
+        self.assertIsInstance(r, BTreeMapSub)
+        r[10] = 10
+        self.assertEqual(1, r.instrument_stats().alloc)
+        r.instrument_disable()
+        self.assertIs(type(r), BTreeMapSub)
+
+    def test_durable(self):
+        with tempfile.TemporaryDirectory() as path:
+            with btree_mini.DurableBTreeMap(path) as r:
+                r.instrument_enable()
+                self.assertIsInstance(r, btree_mini.DurableBTreeMap)
+                for i in range(10):
+                    r[i] = i
+                del r[5]
+                stats = r.instrument_stats()
+                self.assertEqual(10, stats.alloc)
+                self.assertEqual(1, stats.free)
+                r.instrument_disable()
+                self.assertIs(type(r), btree_mini.DurableBTreeMap)
+            with btree_mini.DurableBTreeMap(path) as r:
+                self.assertEqual(9, len(r))
+
+    def test_other_tree_unaffected(self):
+        r = btree_mini.BTreeMap({i: i for i in range(10)})
+        r_other = btree_mini.BTreeMap({i: i for i in range(10)})
+        r.instrument_enable()
+        for i in range(10):
+            r_other[i] = -i
+        self.assertEqual(0, r.instrument_stats().compare)
+
+    def test_shape(self):
+        r = btree_mini.BTreeMap({i: i for i in range(100)})
+        shape = r.shape()
+        self.assertEqual(100, shape["size"])
+        self.assertLessEqual(shape["height"], 2 * shape["black_height"])
+        self.assertEqual(shape["red"] / 100, shape["red_ratio"])
+        self.assertEqual(0, btree_mini.BTreeMap().shape()["height"])
+
+
+class TestMapBuildSorted(unittest.TestCase):
+
+    def test_sizes(self):
+        for total in range(200):
+            nodes = []
+            for i in range(total):
+                node = btree_mini.BNodeMap()
+                node.key = i
+                node.value = -i
+                nodes.append(node)
+            r = btree_mini.BTreeMap()
+            r._root = btree_mini.rb_build_sorted(nodes)
+            self.assertEqual(r.is_valid(), True)
+            self.assertEqual([(i, -i) for i in range(total)], list(r.items()))
+            # ensure the tree remains valid once modified.
+            for i in range(0, total, 3):
+                r.remove(i)
+            r[total] = -total
+            self.assertEqual(r.is_valid(), True)
+
+
+class TestDurableMap(unittest.TestCase):
+
+    def setUp(self):
+        self._tempdir = tempfile.TemporaryDirectory()
+        self.path = self._tempdir.name
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_reopen(self):
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            for i in range(100):
+                r[i] = -i
+            del r[10]
+            r.discard(11)
+            r.pop_min_item()
+            self.assertEqual(-99, r.pop_max_value())
+            d = dict(r.items())
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual(d, dict(r.items()))
+            self.assertEqual(r.is_valid(), True)
+            r.clear()
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual(0, len(r))
+
+    def test_compact(self):
+        with btree_mini.DurableBTreeMap(self.path, compact_size=256) as r:
+            for i in range(100):
+                r[i] = -i
+            for i in range(0, 100, 2):
+                del r[i]
+            self.assertLess(os.path.getsize(os.path.join(self.path, "log")), 256)
+        self.assertTrue(os.path.exists(os.path.join(self.path, "snapshot")))
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual([(i, -i) for i in range(1, 100, 2)], list(r.items()))
+            self.assertEqual(r.is_valid(), True)
+
+    def test_batch(self):
+        r = btree_mini.DurableBTreeMap(self.path, batch_size=10, fsync=False)
+        for i in range(15):
+            r[i] = i
+        # simulate a crash, the pending batch is lost.
+        r._log.close()
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual(list(range(10)), list(r.keys()))
+
+    def test_crash_torn_log(self):
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            for i in range(10):
+                r[i] = i
+        filepath_log = os.path.join(self.path, "log")
+        size = os.path.getsize(filepath_log)
+        # a partially written record.
+        with open(filepath_log, "r+b") as fh:
+            fh.truncate(size - 3)
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual(list(range(9)), list(r.keys()))
+            r[100] = 100
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual(list(range(9)) + [100], list(r.keys()))
+
+    def test_remove_range(self):
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            for i in range(100):
+                r[i] = i
+            r.remove_range(10, 20)
+            r.truncate_before(5)
+            r.truncate_after(90)
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual(list(range(5, 10)) + list(range(20, 91)), list(r.keys()))
+
+    def test_unpicklable(self):
+        class Unpicklable:
+            def __reduce__(self):
+                raise pickle.PicklingError("unpicklable")
+
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            r[1] = 1
+            with self.assertRaises(pickle.PicklingError):
+                r[10] = Unpicklable()
+            self.assertNotIn(10, r)
+            with self.assertRaises(pickle.PicklingError):
+                r[1] = Unpicklable()
+            self.assertEqual(1, r[1])
+            self.assertEqual(1, r.pop_min_value())
+            self.assertEqual(None, r.pop_max_value(None))
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual(0, len(r))
+
+    def test_closed(self):
+        r = btree_mini.DurableBTreeMap(self.path)
+        r[1] = 1
+        r.close()
+        r.close()
+        for fn, args in (
+                (r.insert, (2, 2)),
+                (r.remove, (1,)),
+                (r.discard, (1,)),
+                (r.pop_key, (1,)),
+                (r.pop_min_item, ()),
+                (r.pop_max_value, ()),
+                (r.remove_range, (0, 10)),
+                (r.truncate_after, (0,)),
+                (r.clear, ()),
+                (r.flush, ()),
+                (r.compact, ()),
+        ):
+            with self.assertRaises(ValueError):
+                fn(*args)
+        # reading still works, the tree is unchanged.
+        self.assertEqual([(1, 1)], list(r.items()))
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual([(1, 1)], list(r.items()))
+
+    def test_crash_during_compact(self):
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            for i in range(10):
+                r[i] = i
+            del r[5]
+        filepath_log = os.path.join(self.path, "log")
+        with open(filepath_log, "rb") as fh:
+            log_data = fh.read()
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            r.compact()
+        # simulate a crash after writing the snapshot, before truncating the log.
+        with open(filepath_log, "wb") as fh:
+            fh.write(log_data)
+        with btree_mini.DurableBTreeMap(self.path) as r:
+            self.assertEqual([0, 1, 2, 3, 4, 6, 7, 8, 9], list(r.keys()))
+
+
+# -----------------------------------------------------------------------------
+# Multiple Trees
+
+class TestMergeIter(unittest.TestCase):
+
+    def test_map(self):
+        shards = [
+            btree_mini.BTreeMap({i: shard for i in range(shard, 30, 3 + shard)})
+            for shard in range(3)
+        ]
+        items_all = sorted(
+            (item for r in shards for item in r.items()),
+            key=lambda item: item[0])
+        self.assertEqual(items_all, list(btree_mini.merge_iter(*shards)))
+        self.assertEqual(
+            [k for k, _ in reversed(items_all)],
+            [k for k, _ in btree_mini.merge_iter(*shards, reverse=True)])
+        self.assertEqual(
+            [item for item in items_all if 5 <= item[0] < 20],
+            list(btree_mini.merge_iter(*shards, lo=5, hi=20)))
+        self.assertEqual([], list(btree_mini.merge_iter()))
+
+    def test_dedupe(self):
+        r_a = btree_mini.BTreeMap({i: "a" for i in range(0, 10, 2)})
+        r_b = btree_mini.BTreeMap({i: "b" for i in range(0, 10, 3)})
+        self.assertEqual(
+            [(0, "a"), (2, "a"), (3, "b"), (4, "a"), (6, "a"), (8, "a"), (9, "b")],
+            list(btree_mini.merge_iter(r_a, r_b, dedupe="first")))
+        self.assertEqual(
+            [(9, "b"), (8, "a"), (6, "b"), (4, "a"), (3, "b"), (2, "a"), (0, "b")],
+            list(btree_mini.merge_iter(r_a, r_b, dedupe="last", reverse=True)))
+        self.assertEqual(
+            [(0, "ab"), (6, "ab")],
+            [item for item in btree_mini.merge_iter(
+                r_a, r_b,
+                dedupe=lambda items: (items[0][0], "".join(v for _, v in items)),
+            ) if len(item[1]) == 2])
+
+    def test_set(self):
+        r_a = btree_mini.BTreeSet(range(0, 10, 2))
+        r_b = btree_mini.BTreeSet(range(0, 10, 3))
+        self.assertEqual(
+            sorted(set(r_a) | set(r_b)),
+            list(btree_mini.merge_iter(r_a, r_b, dedupe="first")))
+        with self.assertRaises(TypeError):
+            btree_mini.merge_iter(r_a, btree_mini.BTreeMap())
+        with self.assertRaises(ValueError):
+            btree_mini.merge_iter(r_a, r_b, dedupe="middle")
+
+
+# -----------------------------------------------------------------------------
+# Caches
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+
+    def timer(self):
+        return self.now
+
+    def test_expire(self):
+        c = btree_mini.TTLCache(100, 10.0, timer=self.timer)
+        for i in range(10):
+            self.now = float(i)
+            c[i] = -i
+        self.assertEqual(-5, c[5])
+        self.now = 14.0
+        self.assertNotIn(4, c)
+        self.assertEqual(4, c.expire())
+        self.assertEqual(5, len(c))
+        self.assertEqual(None, c.get(0))
+        self.assertEqual(5, c.evictions)
+        self.assertEqual(1, c.hits)
+        self.assertEqual(1, c.misses)
+
+    def test_touch(self):
+        c = btree_mini.TTLCache(100, 10.0, timer=self.timer)
+        c["a"] = 1
+        c["b"] = 2
+        self.now = 5.0
+        self.assertTrue(c.touch("a"))
+        self.assertFalse(c.touch("c"))
+        self.now = 12.0
+        self.assertEqual(1, c.expire())
+        self.assertEqual(1, c["a"])
+        self.assertNotIn("b", c)
+        c.set("b", 2, ttl=100.0)
+        self.now = 50.0
+        self.assertEqual(1, c.expire())
+        self.assertEqual(["b"], list(c._data))
+
+    def test_maxsize(self):
+        c = btree_mini.TTLCache(3, 10.0, timer=self.timer)
+        for i in range(5):
+            c[i] = i
+        self.assertEqual(3, len(c))
+        self.assertEqual([2, 3, 4], sorted(c._data))
+        self.assertEqual(2, c.evictions)
+        self.assertEqual(2, c.pop(2))
+        self.assertEqual(None, c.pop(2, None))
+        self.assertEqual(c._index.is_valid(), True)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evict(self):
+        c = btree_mini.LRUCache(3)
+        for i in range(3):
+            c[i] = -i
+        self.assertEqual(0, c[0])
+        c[3] = -3
+        self.assertNotIn(1, c)
+        self.assertEqual([0, 2, 3], sorted(c._data))
+        c.touch(2)
+        c[4] = -4
+        c[5] = -5
+        self.assertEqual([2, 4, 5], sorted(c._data))
+        self.assertEqual(3, c.evictions)
+        self.assertEqual(1, c.hits)
+        with self.assertRaises(KeyError):
+            c[0]
+        self.assertEqual(1, c.misses)
+        c.stats_reset()
+        self.assertEqual(0, c.misses)
+
+    def test_no_ttl(self):
+        c = btree_mini.LRUCache(3)
+        with self.assertRaises(TypeError):
+            c.set(1, 1, ttl=5)
+        with self.assertRaises(TypeError):
+            c.touch(1, ttl=5)
+        self.assertEqual(0, len(c))
+        self.assertEqual(len(c), len(c._index))
+
+
 # -----------------------------------------------------------------------------
 # BTreeSet
 #
@@ -224,6 +959,16 @@ class TestSetBasics(unittest.TestCase):
         for a, b in zip(r, r_copy):
             self.assertEqual(a, b)
 
+    def test_eq_diff(self):
+        r_a = btree_mini.BTreeSet(range(0, 10))
+        r_b = btree_mini.BTreeSet(range(5, 15))
+        self.assertEqual(r_a, btree_mini.BTreeSet(reversed(range(0, 10))))
+        self.assertNotEqual(r_a, r_b)
+        self.assertEqual(
+            [("removed", i) for i in range(0, 5)] +
+            [("added", i) for i in range(10, 15)],
+            list(r_a.diff(r_b)))
+
 
 if __name__ == "__main__":
     unittest.main()